@@ -10,8 +10,10 @@ setup(
     classifiers=["Programming Language :: Python :: 3 :: Only"],
     py_modules=["target_azureblobstorage"],
     install_requires=[
+        "fastjsonschema>=2.15",
+        "orjson>=3.0.0",
         "singer-python>=5.0.12",
-        "azure-storage-blob==2.1.0"
+        "azure-storage-blob>=12.0.0"
     ],
     entry_points="""
     [console_scripts]
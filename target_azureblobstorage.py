@@ -5,144 +5,288 @@ import io
 import os
 import shutil
 import gzip
+import tarfile
 import sys
 import json
 import threading
 import http.client
 import urllib
-import time
+from collections import defaultdict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import collections
 
+import fastjsonschema
+import orjson
 import pkg_resources
-from jsonschema.validators import Draft4Validator
-# from jsonschema.exceptions import ValidationError
 import singer
 
-from azure.storage.blob import BlockBlobService, AppendBlobService, ContentSettings
+from azure.storage.blob import BlobServiceClient, ContentSettings
 
 logger = singer.get_logger()
 USER_HOME = os.path.expanduser('~')
+# Records queued per stream before they are handed to the OS in one
+# writelines call.
+WRITE_BATCH = 1000
 
 
 def emit_state(state):
     if state is not None:
-        line = json.dumps(state)
+        line = orjson.dumps(state).decode()
         logger.debug('Emitting state {}'.format(line))
         sys.stdout.write("{}\n".format(line))
         sys.stdout.flush()
 
 
-def flatten(d, parent_key='', sep='__'):
-    items = []
-    for k, v in d.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
-        else:
-            items.append((new_key, str(v) if type(v) is list else v))
-    return dict(items)
+def flatten(d, sep='__'):
+    # Iterative with an explicit stack: the recursive version materialized
+    # an items list per nesting level and re-hashed every key of every
+    # subdict on the way back up. collections.MutableMapping is also gone
+    # in Python 3.10+, so use the abc import.
+    out = {}
+    stack = [('', d)]
+    while stack:
+        prefix, cur = stack.pop()
+        for k, v in cur.items():
+            new_key = prefix + sep + k if prefix else k
+            if isinstance(v, MutableMapping):
+                stack.append((new_key, v))
+            else:
+                out[new_key] = json.dumps(v) if type(v) is list else v
+    return out
+
+
+def iter_lines(buf_reader, bufsize=1 << 20):
+    # Pull stdin in up-to-1 MiB chunks and split in-process: iterating a
+    # file object line by line pays a Python-level newline scan per line,
+    # while one big read amortizes the syscall across thousands of records.
+    # read1 takes whatever the pipe has instead of blocking for a full
+    # bufsize, so a trickling tap still gets its lines processed promptly.
+    tail = b''
+    while chunk := buf_reader.read1(bufsize):
+        parts = (tail + chunk).split(b'\n')
+        tail = parts.pop()
+        yield from filter(None, parts)
+    if tail:
+        yield tail
+
+
+def open_stream_file(path, truncate):
+    # os.open with an explicit flag set skips the extra stat the builtin
+    # open pays to probe the mode string: one syscall per stream open
+    # instead of two. The 1 MiB buffer absorbs the per-batch writes.
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else os.O_APPEND)
+    return os.fdopen(os.open(path, flags, 0o644), 'wb', 1 << 20)
+
+
+def upload_stream_file(container_client, file_path_in, blob_name,
+                       copy_buf, max_connections):
+    # Compress straight into memory and upload from the stream: the old
+    # file->gzip->file->upload round trip read and wrote every byte twice
+    # on disk.
+    buf = io.BytesIO()
+    with open(file_path_in, 'rb') as f_in:
+        # compresslevel 1 is ~4x faster than the default 9 for only a few
+        # percent worse ratio on JSON, and these archives are write-once.
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1) as f_out:
+            shutil.copyfileobj(f_in, f_out, length=copy_buf)
+    buf.seek(0)
+    container_client.upload_blob(
+        blob_name,
+        buf,
+        overwrite=True,
+        content_settings=ContentSettings(
+            content_type='application/JSON'),
+        max_concurrency=max_connections
+    )
+    try:
+        os.remove(file_path_in)
+    except:
+        logger.debug(f"unable to delete file {file_path_in}")
 
 
-def persist_lines(block_blob_service, blob_container_name, lines):
+def persist_lines(container_client, blob_container_name, lines, config=None):
+    config = config or {}
     state = None
     schemas = {}
     key_properties = {}
     validators = {}
+    # One long-lived buffered writer per stream: opening the file once and
+    # letting the 1 MiB buffer absorb the per-record writes avoids an
+    # open/close syscall pair and a flush for every RECORD line.
+    writers = {}
+    # Stream file paths are invariant per stream; build them once at SCHEMA
+    # time instead of an os.path.join per record.
+    stream_paths = {}
+    # Staging file name -> blob name prefix, filled at SCHEMA time so the
+    # upload loop does not re-derive the stream name per file.
+    blob_prefixes = {}
+    # Raw line bytes queued per stream, flushed WRITE_BATCH records at a
+    # time with a single writelines call (two entries per record: the line
+    # and the shared b',\n' suffix, so nothing is concatenated per record).
+    pending = defaultdict(list)
+    # Streams whose staging file this run has already opened once: the
+    # first open truncates any leftovers from a previous run, later
+    # re-opens (after a checkpoint upload) append.
+    touched = set()
+
+    def flush_pending(stream):
+        chunks = pending.get(stream)
+        if not chunks:
+            return
+        file_obj = writers.get(stream)
+        if file_obj is None:
+            file_obj = writers[stream] = open_stream_file(
+                stream_paths[stream], truncate=stream not in touched)
+            touched.add(stream)
+        file_obj.writelines(chunks)
+        chunks.clear()
+
+    # Buffer for file->gzip copies in the STATE flush, tunable because the
+    # sweet spot depends on disk and record size; 1 MiB is a good default.
+    copy_buf = config.get('copy_buf_kb', 1024) * 1024
+    # Uploads are network-bound: overlap whole-file uploads across a small
+    # thread pool and let the SDK stage blocks in parallel within each one.
+    upload_workers = config.get('upload_workers', 4)
+    max_connections = config.get('max_connections', 8)
 
     parent_dir = os.path.join(USER_HOME, blob_container_name)
-    # clean temp folder for local file creation
-    shutil.rmtree(parent_dir, ignore_errors=True)
-    time.sleep(1)
-    os.mkdir(parent_dir)
-    time.sleep(1)
-
-    # Loop over lines from stdin
-    for line in lines:
-        try:
-            line_json = json.loads(line)
-        except json.decoder.JSONDecodeError:
-            logger.error("Unable to parse:\n{}".format(line))
-            raise
-
-        if 'type' not in line_json:
-            raise Exception("Line is missing required key 'type': {}".format(line))
-        t = line_json['type']
-
-        if t == 'RECORD':
-            if 'stream' not in line_json:
-                raise Exception("Line is missing required key 'stream': {}".format(line))
-            if line_json['stream'] not in schemas:
-                raise Exception(
-                    "A record for stream {} was encountered before a corresponding schema".format(line_json['stream']))
-
-            # Get schema for this record's stream
-            schema = schemas[line_json['stream']]
-
-            logger.debug('schema for this records stream {}'.format(schema))
-            logger.debug('Validate record {}'.format(line_json))
-            # Validate record
-            #validators[line_json['stream']].validate(line_json['record'])
-
-            # If the record needs to be flattened, uncomment this line
-            # flattened_record = flatten(o['record'])
-            filename = line_json['stream'] + '.json'
-            stream_path = os.path.join(parent_dir, filename)
-            with open(stream_path, "a") as file_obj:
-                # todo creare un buffer (dim da config) in cui accumulare le righe e scrivere solo quando il buffer è pieno
-                file_obj.write(json.dumps(line_json['record']) + ',\n')
-
-            state = None
-
-        elif t == 'STATE':
-            logger.debug('Setting state to {}'.format(line_json['value']))
-            state = line_json['value']
-
-            if not state['currently_syncing'] and os.path.exists(parent_dir):
-                time.sleep(1)
-                for _file in os.listdir(parent_dir):
-                    now = datetime.now().strftime('%Y%m%dT%H%M%S')
-                    output_file_name = now + ".json.gz"
-                    file_path_in = os.path.join(parent_dir, _file)
-                    file_path_out = os.path.join(parent_dir, output_file_name)
-                    with open(file_path_in, 'rb') as f_in:
-                        with gzip.open(file_path_out, 'wb') as f_out:
-                            shutil.copyfileobj(f_in, f_out, length=1024*1024)
-                    time.sleep(1)
-                    block_blob_service.create_blob_from_path(
-                        blob_container_name,
-                        _file.replace(".json", "") + "/" + output_file_name,
-                        file_path_out,
-                        content_settings=ContentSettings(
-                            content_type='application/JSON')
-                    )
-                    time.sleep(1)
-                    try:
-                        os.remove(file_path_in)
-                    except:
-                        logger.debug(f"unable to delete file {file_path_in}")
-                    time.sleep(1)
+    # Reuse the staging directory across runs: the old rmtree + mkdir threw
+    # away every cached dentry and page on each invocation. Stream files
+    # are truncated lazily on first touch instead.
+    os.makedirs(parent_dir, exist_ok=True)
+
+    try:
+        # Loop over lines from stdin
+        for line in iter_lines(lines):
+            try:
+                # orjson parses several times faster than stdlib json and takes
+                # the stdin bytes as-is; this loop is the target's top CPU cost.
+                line_json = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                logger.error("Unable to parse:\n{}".format(line))
+                raise
+
+            if 'type' not in line_json:
+                raise Exception("Line is missing required key 'type': {}".format(line))
+            t = line_json['type']
+
+            if t == 'RECORD':
+                if 'stream' not in line_json:
+                    raise Exception("Line is missing required key 'stream': {}".format(line))
+                # Bind the stream name once: every line_json['stream'] lookup is
+                # a hash+probe repeated for each of millions of records.
+                stream = line_json['stream']
+                if stream not in schemas:
+                    raise Exception(
+                        "A record for stream {} was encountered before a corresponding schema".format(stream))
+
+                # Validate record (compiled, so this is a plain function call)
+                validators[stream](line_json['record'])
+
+                # If the record needs to be flattened, uncomment this line
+                # flattened_record = flatten(o['record'])
+                # Queue the bare record, as the blobs have always contained;
+                # orjson.dumps emits bytes directly, so serializing the
+                # record subobject costs far less than the stdlib round trip.
+                chunks = pending[stream]
+                chunks += (orjson.dumps(line_json['record']), b',\n')
+                if len(chunks) >= 2 * WRITE_BATCH:
+                    flush_pending(stream)
+
+                state = None
+
+            elif t == 'STATE':
+                logger.debug('Setting state to {}'.format(line_json['value']))
+                state = line_json['value']
+
+                if not state['currently_syncing']:
+                    # The stream files are uploaded and removed below, so drain
+                    # the queues and close every writer before reading them back.
+                    for stream in list(pending):
+                        flush_pending(stream)
+                    for file_obj in writers.values():
+                        file_obj.close()
+                    writers.clear()
+                    # One scandir pass replaces the exists precheck plus listdir
+                    # plus a join/stat per file: DirEntry carries the absolute
+                    # path and a cached stat.
                     try:
-                        os.remove(file_path_out)
-                    except:
-                        logger.debug(f"unable to delete file {file_path_out}")
-                    time.sleep(1)
-
-        elif t == 'SCHEMA':
-            if 'stream' not in line_json:
-                raise Exception("Line is missing required key 'stream': {}".format(line))
-            stream = line_json['stream']
-            schemas[stream] = line_json['schema']
-            validators[stream] = Draft4Validator(line_json['schema'])
-            if 'key_properties' not in line_json:
-                raise Exception("key_properties field is required")
-            key_properties[stream] = line_json['key_properties']
-
-        elif t == 'ACTIVATE_VERSION':
-            logger.debug("Type {} in message {}".format(line_json['type'], line_json))
-
-        else:
-            raise Exception("Unknown message type {} in message {}".format(line_json['type'], line_json))
+                        with os.scandir(parent_dir) as it:
+                            entries = [e for e in it if e.is_file()]
+                    except FileNotFoundError:
+                        entries = []
+                    if not entries:
+                        continue
+                    # One timestamp per checkpoint: it names every blob of
+                    # this flush, and taking it fresh here keeps successive
+                    # flushes from overwriting each other's blobs. The
+                    # microseconds matter: back-to-back flushes easily land
+                    # in the same second and the uploads pass overwrite=True.
+                    now = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+                    if config.get('aggregate_uploads', False):
+                        # With many small streams every blob PUT pays a TLS
+                        # handshake, an auth signature and a server-side commit;
+                        # bundle them into a single tar.gz PUT per checkpoint.
+                        buf = io.BytesIO()
+                        with tarfile.open(fileobj=buf, mode='w:gz', compresslevel=1) as tar:
+                            for entry in entries:
+                                tar.add(entry.path, arcname=entry.name)
+                        buf.seek(0)
+                        container_client.upload_blob(
+                            now + ".tar.gz",
+                            buf,
+                            overwrite=True,
+                            content_settings=ContentSettings(
+                                content_type='application/gzip'),
+                            max_concurrency=max_connections
+                        )
+                        for entry in entries:
+                            try:
+                                os.remove(entry.path)
+                            except:
+                                logger.debug(f"unable to delete file {entry.path}")
+                        continue
+                    with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+                        futures = [
+                            executor.submit(
+                                upload_stream_file, container_client, entry.path,
+                                "{}/{}.json.gz".format(
+                                    blob_prefixes.get(entry.name) or entry.name.replace(".json", ""),
+                                    now),
+                                copy_buf, max_connections)
+                            for entry in entries
+                        ]
+                        for future in futures:
+                            future.result()
+
+            elif t == 'SCHEMA':
+                if 'stream' not in line_json:
+                    raise Exception("Line is missing required key 'stream': {}".format(line))
+                stream = line_json['stream']
+                schemas[stream] = line_json['schema']
+                stream_paths[stream] = os.path.join(parent_dir, stream + '.json')
+                blob_prefixes[stream + '.json'] = stream
+                # Compile the schema to a straight-line Python function once per
+                # stream instead of re-walking the schema tree per record.
+                validators[stream] = fastjsonschema.compile(line_json['schema'])
+                if 'key_properties' not in line_json:
+                    raise Exception("key_properties field is required")
+                key_properties[stream] = line_json['key_properties']
+
+            elif t == 'ACTIVATE_VERSION':
+                logger.debug("Type {} in message {}".format(line_json['type'], line_json))
+
+            else:
+                raise Exception("Unknown message type {} in message {}".format(line_json['type'], line_json))
+
+        for stream in list(pending):
+            flush_pending(stream)
+    finally:
+        # Close whatever is open even on a failed run so no buffered
+        # data or file descriptors are left dangling.
+        for file_obj in writers.values():
+            file_obj.close()
 
     return state
 
@@ -150,7 +294,7 @@ def persist_lines(block_blob_service, blob_container_name, lines):
 def send_usage_stats():
     try:
         version = pkg_resources.get_distribution('target-azureblobstorage').version
-        conn = http.client.HTTPConnection('collector.singer.io', timeout=10)
+        conn = http.client.HTTPConnection('collector.singer.io', timeout=2)
         conn.connect()
         params = {
             'e': 'se',
@@ -181,14 +325,35 @@ def main():
         logger.info('Sending version information to singer.io. ' +
                     'To disable sending anonymous usage data, set ' +
                     'the config parameter "disable_collection" to true')
-        threading.Thread(target=send_usage_stats).start()
-
-    block_blob_service = BlockBlobService(config.get('account_name', None), config.get('account_key', None))
+        # Daemon so a slow collector can never hold up interpreter exit;
+        # usage stats are best-effort.
+        threading.Thread(target=send_usage_stats, daemon=True).start()
+
+    # v12 SDK: one client with a shared connection pool instead of the
+    # deprecated v2 BlockBlobService that reconnected per request.
+    # Transfer tuning: 4 MiB blocks staged max_connections at a time is a
+    # good default; raise max_block_mb on fat pipes, raise
+    # max_single_put_mb if blobs routinely fit in one PutBlob.
+    max_block_size = config.get('max_block_mb', 4) * 1024 * 1024
+    max_single_put_size = config.get('max_single_put_mb', 64) * 1024 * 1024
+    if config.get('connection_string'):
+        blob_service_client = BlobServiceClient.from_connection_string(
+            config['connection_string'],
+            max_single_put_size=max_single_put_size,
+            max_block_size=max_block_size)
+    else:
+        blob_service_client = BlobServiceClient(
+            account_url="https://{}.blob.core.windows.net".format(config.get('account_name', None)),
+            credential=config.get('account_key', None),
+            max_single_put_size=max_single_put_size,
+            max_block_size=max_block_size)
 
     blob_container_name = config.get('container_name', None)
+    container_client = blob_service_client.get_container_client(blob_container_name)
 
-    input = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    state = persist_lines(block_blob_service, blob_container_name, input)
+    # Read stdin as bytes: orjson parses bytes directly, so decoding to str
+    # up front is pure overhead.
+    state = persist_lines(container_client, blob_container_name, sys.stdin.buffer, config)
 
     emit_state(state)
     logger.debug("Exiting normally")